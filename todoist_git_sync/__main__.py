@@ -1,196 +1,457 @@
+from asyncio import Semaphore, gather, run, sleep
+from collections import defaultdict
 from datetime import datetime, timedelta
-from itertools import groupby
+from hashlib import sha1
+from io import BytesIO
+from itertools import chain
 from pathlib import Path
+from random import uniform
+from re import compile as re_compile
 from tempfile import TemporaryDirectory
-from typing import Optional
-
-from git import Repo, PushInfo
-from ratelimit import rate_limited, sleep_and_retry
-from requests import Session
-from requests.adapters import HTTPAdapter
-from requests.exceptions import HTTPError
-from todoist_api_python.api import TodoistAPI
-from tqdm import tqdm
-from urllib3 import Retry
+from typing import Any, Iterable, Optional
+from urllib.parse import quote
+
+from git import Blob, Repo, PushInfo
+from gitdb import IStream
+from httpx import AsyncClient, AsyncHTTPTransport, TransportError
+from orjson import loads
+from platformdirs import user_cache_dir
+from todoist_api_python.models import Project, Task
+from tqdm.asyncio import tqdm_asyncio
 from yaml import safe_load
 
 from todoist_git_sync.model import TaskInfo
 
 _CONFIG_FILE = Path(__file__).parent.parent / "config.yaml"
 
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_MAX_RETRIES = 10
+_INITIAL_BACKOFF = 1.0
+_MAX_BACKOFF = 60.0
 
-def _sync(
-        todoist_token: str,
-        todoist_project_id: str,
-        git_repository_url: str,
-        git_name: str,
-        git_email: str,
-        export_path: str,
-        commit_message: str,
-) -> None:
-    session = Session()
-    retries = Retry(
-        total=10,
-        backoff_factor=1,
-        status_forcelist=[502, 503, 504],
-    )
-    # noinspection HttpUrlsUsage
-    session.mount("http://", HTTPAdapter(max_retries=retries))
-    session.mount("https://", HTTPAdapter(max_retries=retries))
-
-    with TemporaryDirectory() as temp_dir:
-        git_repository_path = Path(temp_dir)
-        git_repository = Repo.clone_from(
-            git_repository_url,
-            git_repository_path,
-            multi_options=["--depth", "1"]
-        )
-        with git_repository.config_writer() as git_config:
-            git_config.set_value("user", "name", git_name)
-            git_config.set_value("user", "email", git_email)
+_COMPLETED_PAGE_SIZE = 200
+_COMPLETED_CONCURRENT_PAGES = 5
+_DEFAULT_COMPLETED_TASKS_LIMIT = 200
 
-        git_export_path = git_repository_path / export_path
+_GIT_URL_PATTERN = re_compile(
+    r"(?:[\w+]+://)?(?:[^@/]+@)?(?P<host>[^:/]+)(?::\d+)?[:/]"
+    r"(?P<path>.+?)(?:\.git)?/?"
+)
+# API endpoints returning the blob SHA of a file at HEAD, together with
+# the characters to leave unquoted in URL parts and the SHA's JSON key.
+_PUBLISHED_BLOB_APIS = {
+    "github.com": (
+        "https://api.github.com/repos/{path}/contents/{export_path}",
+        "/",
+        "sha",
+    ),
+    "gitlab.com": (
+        "https://gitlab.com/api/v4/projects/{path}"
+        "/repository/files/{export_path}?ref=HEAD",
+        "",
+        "blob_id",
+    ),
+}
 
-        todoist_api = TodoistAPI(todoist_token, session)
 
-        project = todoist_api.get_project(todoist_project_id)
-        open_tasks = [
-            TaskInfo.from_task(task)
-            for task in todoist_api.get_tasks(project_id=todoist_project_id)
-        ]
+async def _request_json(
+        client: AsyncClient,
+        method: str,
+        url: str,
+        allow_missing: bool = False,
+        **kwargs: Any,
+) -> Optional[Any]:
+    backoff = _INITIAL_BACKOFF
+    for retries_left in range(_MAX_RETRIES, -1, -1):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except TransportError:
+            # The transport only retries connecting, so also retry
+            # read timeouts and dropped connections here.
+            if retries_left == 0:
+                raise
+            retry_after = None
+        else:
+            if response.status_code == 404 and allow_missing:
+                return None
+            if (response.status_code not in _RETRY_STATUSES or
+                    retries_left == 0):
+                response.raise_for_status()
+                return loads(response.content)
+            retry_after = response.headers.get("Retry-After")
+        # Back off only when the API pushes back.
+        if retry_after is not None and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = min(uniform(backoff, backoff * 2), _MAX_BACKOFF)
+        backoff = min(backoff * 2, _MAX_BACKOFF)
+        await sleep(delay)
+
 
-        completed_tasks_legacy = session.post(
+async def _get_completed_task_ids(
+        client: AsyncClient,
+        todoist_project_id: str,
+        completed_tasks_limit: Optional[int],
+) -> list[str]:
+    def page_size(offset: int) -> int:
+        if completed_tasks_limit is None:
+            return _COMPLETED_PAGE_SIZE
+        return min(_COMPLETED_PAGE_SIZE, completed_tasks_limit - offset)
+
+    async def get_page(offset: int) -> list[dict[str, Any]]:
+        response = await _request_json(
+            client,
+            "POST",
             "https://api.todoist.com/sync/v9/completed/get_all",
-            headers={"Authorization": f"Bearer {todoist_token}"},
             data={
                 "project_id": todoist_project_id,
-                "limit": 200,
-            }
-        ).json()["items"]
-        completed_tasks_legacy = sorted(
-            completed_tasks_legacy,
-            key=lambda task: datetime.fromisoformat(
-                task["completed_at"].removesuffix("Z")
-            )
+                "limit": str(page_size(offset)),
+                "offset": str(offset),
+            },
         )
-        completed_tasks_legacy = tqdm(
-            completed_tasks_legacy,
-            desc="Load completed tasks",
-            unit="task",
+        return response["items"]
+
+    # Items are returned newest first. Recurring tasks can be completed
+    # multiple times, so keep only their latest completion.
+    completed_at: dict[str, datetime] = {}
+    # Most projects fit into one page, so only fan out if it is full.
+    offsets = [0] if page_size(0) > 0 else []
+    while len(offsets) > 0:
+        pages = await gather(*(get_page(offset) for offset in offsets))
+        for items in pages:
+            for item in items:
+                completed_at.setdefault(
+                    item["task_id"],
+                    # Python 3.11 parses the trailing "Z" natively.
+                    datetime.fromisoformat(item["completed_at"]),
+                )
+        if any(
+                len(items) < page_size(offset)
+                for offset, items in zip(offsets, pages)
+        ):
+            break
+        start = offsets[-1] + _COMPLETED_PAGE_SIZE
+        offsets = [
+            offset
+            for offset in range(
+                start,
+                start + _COMPLETED_CONCURRENT_PAGES * _COMPLETED_PAGE_SIZE,
+                _COMPLETED_PAGE_SIZE,
+            )
+            if page_size(offset) > 0
+        ]
+    return sorted(completed_at, key=completed_at.__getitem__)
+
+
+async def _get_project(
+        client: AsyncClient,
+        todoist_project_id: str,
+) -> Project:
+    project = await _request_json(
+        client,
+        "GET",
+        f"https://api.todoist.com/rest/v2/projects/{todoist_project_id}",
+    )
+    return Project.from_dict(project)
+
+
+async def _get_open_tasks(
+        client: AsyncClient,
+        todoist_project_id: str,
+) -> list[TaskInfo]:
+    tasks = await _request_json(
+        client,
+        "GET",
+        "https://api.todoist.com/rest/v2/tasks",
+        params={"project_id": todoist_project_id},
+    )
+    return [
+        TaskInfo.from_task(Task.from_dict(task))
+        for task in tasks
+    ]
+
+
+async def _get_completed_tasks(
+        client: AsyncClient,
+        todoist_project_id: str,
+        completed_tasks_limit: Optional[int],
+) -> list[TaskInfo]:
+    semaphore = Semaphore(15)
+
+    async def get_task_info(task_id: str) -> Optional[TaskInfo]:
+        async with semaphore:
+            task = await _request_json(
+                client,
+                "GET",
+                f"https://api.todoist.com/rest/v2/tasks/{task_id}",
+                # Deleted tasks are skipped.
+                allow_missing=True,
+            )
+        if task is None:
+            return None
+        return TaskInfo.from_task(Task.from_dict(task))
+
+    task_ids = await _get_completed_task_ids(
+        client,
+        todoist_project_id,
+        completed_tasks_limit,
+    )
+    completed_tasks = await tqdm_asyncio.gather(
+        *(get_task_info(task_id) for task_id in task_ids),
+        desc="Load completed tasks",
+        unit="task",
+        # Skip the progress bar in headless runs, e.g., cron jobs.
+        disable=None,
+    )
+    return [
+        task for task in completed_tasks if task is not None
+    ]
+
+
+async def _load_project(
+        todoist_token: str,
+        todoist_project_id: str,
+        completed_tasks_limit: Optional[int],
+) -> tuple[Project, list[TaskInfo], list[TaskInfo]]:
+    # HTTP/2 multiplexes all requests over a single connection.
+    async with AsyncClient(
+            headers={"Authorization": f"Bearer {todoist_token}"},
+            timeout=30,
+            transport=AsyncHTTPTransport(http2=True, retries=_MAX_RETRIES),
+    ) as client:
+        # The requests are independent, so issue them concurrently.
+        return await gather(
+            _get_project(client, todoist_project_id),
+            _get_open_tasks(client, todoist_project_id),
+            _get_completed_tasks(
+                client,
+                todoist_project_id,
+                completed_tasks_limit,
+            ),
         )
 
-        @sleep_and_retry
-        @rate_limited(calls=15, period=10)
-        def get_task_info(task_id: str) -> Optional[TaskInfo]:
-            try:
-                task = todoist_api.get_task(task_id)
-            except HTTPError as e:
-                if e.response.status_code != 404:
-                    raise e
-                return None
-            return TaskInfo.from_task(task)
 
-        completed_tasks = (
-            get_task_info(task_legacy["task_id"])
-            for task_legacy in completed_tasks_legacy
+def _git_blob_sha(data: bytes) -> str:
+    return sha1(b"blob " + str(len(data)).encode() + b"\0" + data).hexdigest()
+
+
+async def _get_published_blob_sha(
+        git_repository_url: str,
+        export_path: str,
+) -> Optional[str]:
+    match = _GIT_URL_PATTERN.fullmatch(git_repository_url)
+    if match is None or match["host"] not in _PUBLISHED_BLOB_APIS:
+        return None
+    url_template, safe, sha_key = _PUBLISHED_BLOB_APIS[match["host"]]
+    # Ask the API rather than raw file endpoints, which may serve content
+    # that is several minutes old.
+    try:
+        url = url_template.format(
+            path=quote(match["path"], safe=safe),
+            export_path=quote(Path(export_path).as_posix(), safe=safe),
         )
-        completed_tasks = [
-            task for task in completed_tasks if task is not None
-        ]
+        # Don't send the Todoist token to the Git host.
+        async with AsyncClient(
+                http2=True,
+                timeout=30,
+                headers={"Cache-Control": "no-cache"},
+        ) as client:
+            response = await client.get(url)
+        if response.status_code != 200:
+            # E.g., private repositories, new files, or rate limits.
+            return None
+        return loads(response.content)[sha_key]
+    except Exception:
+        # The probe is only a shortcut, so fall back to Git on any error.
+        return None
 
-        backlog_tasks = [
-            task
-            for task in open_tasks
-            if task.due_at is None
-        ]
-        scheduled_tasks = [
-            task
-            for task in open_tasks
-            if task.due_at is not None
-        ]
-        now = datetime.now()
-        future_tasks = [
-            task
-            for task in scheduled_tasks
-            if task.due_at > now
-        ]
-        overdue_tasks = [
-            task
-            for task in scheduled_tasks
-            if task.due_at <= now
-        ]
-        future_week_tasks = {
-            week: list(tasks)
-            for week, tasks in groupby(
-                future_tasks,
-                key=lambda task: int(task.due_at.strftime("%W"))
-            )
-        }
-        overdue_week_tasks = {
-            week: list(tasks)
-            for week, tasks in groupby(
-                overdue_tasks,
-                key=lambda task: int(task.due_at.strftime("%W"))
-            )
-        }
-
-        with git_export_path.open("w") as file:
-            file.write("# Roadmap\n\n")
-            file.write(
-                f"Tasks automatically exported from "
-                f"Todoist project [{project.name}]({project.url}).\n\n"
-                f"Jump to [future tasks](#future-tasks) "
-                f"or to the [backlog](#backlog).\n\n"
+
+async def _load(
+        todoist_token: str,
+        todoist_project_id: str,
+        completed_tasks_limit: Optional[int],
+        git_repository_url: str,
+        export_path: str,
+) -> tuple[tuple[Project, list[TaskInfo], list[TaskInfo]], Optional[str]]:
+    return await gather(
+        _load_project(
+            todoist_token,
+            todoist_project_id,
+            completed_tasks_limit,
+        ),
+        _get_published_blob_sha(git_repository_url, export_path),
+    )
+
+
+def _group_by_week(
+        tasks: Iterable[TaskInfo],
+) -> dict[tuple[int, int], list[TaskInfo]]:
+    week_tasks: defaultdict[tuple[int, int], list[TaskInfo]] = \
+        defaultdict(list)
+    for task in tasks:
+        # ISO weeks start on Monday, like the week headers.
+        year, week, _ = task.due_at.isocalendar()
+        week_tasks[year, week].append(task)
+    # Tasks are not necessarily sorted by due date.
+    return dict(sorted(week_tasks.items()))
+
+
+def _week_header(week_tasks: list[TaskInfo]) -> str:
+    week_date = week_tasks[0].due_at
+    start = week_date - timedelta(days=week_date.weekday())
+    end = start + timedelta(days=6)
+    return f"### From {start:%Y/%m/%d} to {end:%Y/%m/%d}\n\n"
+
+
+def _render_roadmap(
+        project: Project,
+        open_tasks: list[TaskInfo],
+        completed_tasks: list[TaskInfo],
+) -> str:
+    backlog_tasks = [
+        task
+        for task in open_tasks
+        if task.due_at is None
+    ]
+    scheduled_tasks = [
+        task
+        for task in open_tasks
+        if task.due_at is not None
+    ]
+    now = datetime.now()
+    future_tasks = [
+        task
+        for task in scheduled_tasks
+        if task.due_at > now
+    ]
+    overdue_tasks = [
+        task
+        for task in scheduled_tasks
+        if task.due_at <= now
+    ]
+    future_week_tasks = _group_by_week(future_tasks)
+    overdue_week_tasks = _group_by_week(overdue_tasks)
+
+    markdown: list[str] = ["# Roadmap\n\n"]
+    markdown.append(
+        f"Tasks automatically exported from "
+        f"Todoist project [{project.name}]({project.url}).\n\n"
+        f"Jump to [future tasks](#future-tasks) "
+        f"or to the [backlog](#backlog).\n\n"
+    )
+    markdown.append("## Completed tasks\n\n")
+    markdown.append(
+        "<details>\n<summary>Show completed tasks</summary>\n\n")
+    markdown.extend(task.to_markdown() for task in completed_tasks)
+    markdown.append("\n")
+    markdown.append("</details>\n\n")
+    markdown.append("## Overdue tasks\n\n")
+    for week_tasks in overdue_week_tasks.values():
+        markdown.append(_week_header(week_tasks))
+        markdown.extend(task.to_markdown() for task in week_tasks)
+        markdown.append("\n")
+    markdown.append("## Future tasks\n\n")
+    for week_tasks in future_week_tasks.values():
+        markdown.append(_week_header(week_tasks))
+        markdown.extend(task.to_markdown() for task in week_tasks)
+        markdown.append("\n")
+    markdown.append("## Backlog\n\n")
+    markdown.extend(task.to_markdown() for task in backlog_tasks)
+
+    markdown.append("\n\n")
+    # A task may be both completed and open, but needs only one link.
+    all_tasks = {
+        task.id: task
+        for task in chain(completed_tasks, open_tasks)
+    }
+    markdown.extend(task.to_markdown_ref() for task in all_tasks.values())
+
+    return "".join(markdown)
+
+
+def _open_repository(git_repository_url: str) -> Repo:
+    # Reuse the clone from previous runs, so only new objects are fetched.
+    git_repository_path = Path(user_cache_dir("todoist-git-sync")) / \
+        sha1(git_repository_url.encode()).hexdigest()
+    if git_repository_path.exists():
+        git_repository = Repo(git_repository_path)
+        git_repository.remotes.origin.fetch(depth=1)
+    else:
+        # Clone next to the cache and move it into place afterwards,
+        # so an interrupted clone never leaves a broken cache behind.
+        git_repository_path.parent.mkdir(parents=True, exist_ok=True)
+        with TemporaryDirectory(dir=git_repository_path.parent) as temp_dir:
+            temp_repository_path = Path(temp_dir) / "repository"
+            Repo.clone_from(
+                git_repository_url,
+                temp_repository_path,
+                multi_options=[
+                    "--depth", "1",
+                    "--filter=blob:none",
+                    "--no-checkout",
+                    "--single-branch",
+                ]
             )
-            file.write("## Completed tasks\n\n")
-            file.write(
-                "<details>\n<summary>Show completed tasks</summary>\n\n")
-            for task in completed_tasks:
-                file.write(task.to_markdown())
-            file.write("\n")
-            file.write("</details>\n\n")
-            file.write("## Overdue tasks\n\n")
-            for week, overdue_tasks in overdue_week_tasks.items():
-                week_date = overdue_tasks[0].due_at
-                start = week_date - timedelta(days=week_date.weekday())
-                end = start + timedelta(days=6)
-                file.write(
-                    f"### From {start.strftime('%Y/%m/%d')} "
-                    f"to {end.strftime('%Y/%m/%d')}\n\n"
-                )
-                for task in overdue_tasks:
-                    file.write(task.to_markdown())
-                file.write("\n")
-            file.write("## Future tasks\n\n")
-            for week, future_tasks in future_week_tasks.items():
-                week_date = future_tasks[0].due_at
-                start = week_date - timedelta(days=week_date.weekday())
-                end = start + timedelta(days=6)
-                file.write(
-                    f"### From {start.strftime('%Y/%m/%d')} "
-                    f"to {end.strftime('%Y/%m/%d')}\n\n"
-                )
-                for task in future_tasks:
-                    file.write(task.to_markdown())
-                file.write("\n")
-            file.write("## Backlog\n\n")
-            for task in backlog_tasks:
-                file.write(task.to_markdown())
+            temp_repository_path.rename(git_repository_path)
+        git_repository = Repo(git_repository_path)
+    # The working tree is never checked out, so only trees are downloaded.
+    git_repository.git.update_ref("HEAD", "@{upstream}")
+    return git_repository
+
+
+def _sync(
+        todoist_token: str,
+        todoist_project_id: str,
+        git_repository_url: str,
+        git_name: str,
+        git_email: str,
+        export_path: str,
+        commit_message: str,
+        completed_tasks_limit: Optional[int],
+) -> None:
+    (project, open_tasks, completed_tasks), published_sha = run(_load(
+        todoist_token,
+        todoist_project_id,
+        completed_tasks_limit,
+        git_repository_url,
+        export_path,
+    ))
+
+    data = _render_roadmap(project, open_tasks, completed_tasks).encode()
+    if _git_blob_sha(data) == published_sha:
+        # Nothing has changed, so don't even clone the repository.
+        return
 
-            file.write("\n\n")
-            for task in [*completed_tasks, *open_tasks]:
-                file.write(task.to_markdown_ref())
+    git_repository = _open_repository(git_repository_url)
+    with git_repository.config_writer() as git_config:
+        git_config.set_value("user", "name", git_name)
+        git_config.set_value("user", "email", git_email)
 
-        if not git_repository.is_dirty(untracked_files=True):
-            # Nothing has changed.
-            return
+    # Store the document as a blob directly, without a working tree.
+    blob_sha = git_repository.odb.store(
+        IStream(Blob.type, len(data), BytesIO(data))
+    ).hexsha.decode()
+    export_path = Path(export_path).as_posix()
+    try:
+        head_blob = git_repository.head.commit.tree / export_path
+    except KeyError:
+        head_blob = None
+    if head_blob is not None and head_blob.hexsha == blob_sha:
+        # Nothing has changed.
+        return
 
-        git_repository.index.add([
-            git_export_path.relative_to(git_repository_path)
-        ])
-        git_repository.index.commit(commit_message)
-        git_push_info: PushInfo = git_repository.remotes.origin.push()[0]
-        assert git_push_info.flags == PushInfo.FAST_FORWARD
+    git_repository.git.read_tree("HEAD")
+    git_repository.git.update_index(
+        "--add", "--cacheinfo", f"100644,{blob_sha},{export_path}"
+    )
+    # Other blobs may be missing locally, which is fine for a partial clone.
+    tree_sha = git_repository.git.write_tree("--missing-ok")
+    commit_sha = git_repository.git.commit_tree(
+        tree_sha, "-p", "HEAD", "-m", commit_message
+    )
+    git_repository.git.update_ref("HEAD", commit_sha)
+    git_push_info: PushInfo = git_repository.remotes.origin.push()[0]
+    assert git_push_info.flags == PushInfo.FAST_FORWARD
 
 
 def main() -> None:
@@ -203,6 +464,11 @@ def main() -> None:
     git_email = config["gitEmail"]
     export_path = config["exportPath"]
     commit_message = config["commitMessage"]
+    # Set to null to load the whole history.
+    completed_tasks_limit = config.get(
+        "completedTasksLimit",
+        _DEFAULT_COMPLETED_TASKS_LIMIT,
+    )
     _sync(
         todoist_token,
         todoist_project_id,
@@ -211,6 +477,7 @@ def main() -> None:
         git_email,
         export_path,
         commit_message,
+        completed_tasks_limit,
     )
 
 
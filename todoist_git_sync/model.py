@@ -1,12 +1,18 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from textwrap import indent
 from typing import Optional
 
-from todoist_api_python.models import Task
+from todoist_api_python.models import Due, Task
 
+_PRIORITY_MARKERS = {
+    4: " ❗",
+    3: " ❕",
+    2: " ❕",
+}
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class TaskInfo:
     id: str
     url: str
@@ -15,6 +21,23 @@ class TaskInfo:
     due_at: Optional[datetime]
     is_completed: bool
     priority: int
+    _markdown: str = field(init=False, repr=False, compare=False)
+    _markdown_ref: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # Render once, as the dataclass is immutable anyway.
+        object.__setattr__(self, "_markdown", self._render_markdown())
+        object.__setattr__(self, "_markdown_ref", self._render_markdown_ref())
+
+    @staticmethod
+    def _parse_due(due: Optional[Due]) -> Optional[datetime]:
+        if due is None:
+            return None
+        due_at = due.datetime if due.datetime is not None else due.date
+        # Strip the UTC designator to keep all due dates naive.
+        if due_at.endswith("Z"):
+            due_at = due_at[:-1]
+        return datetime.fromisoformat(due_at)
 
     @classmethod
     def from_task(
@@ -29,20 +52,12 @@ class TaskInfo:
                 task.description
                 if len(task.description) > 0 else None
             ),
-            due_at=(
-                (
-                    datetime.fromisoformat(task.due.datetime.removesuffix("Z"))
-                    if task.due.datetime is not None
-                    else datetime.fromisoformat(task.due.date)
-                )
-                if task.due is not None
-                else None
-            ),
+            due_at=cls._parse_due(task.due),
             is_completed=task.is_completed,
             priority=task.priority,
         )
 
-    def to_markdown(self) -> str:
+    def _render_markdown(self) -> str:
         completed = "x" if self.is_completed else " "
         description: str
         if self.description is not None:
@@ -52,13 +67,15 @@ class TaskInfo:
             description = f"  \n{description}"
         else:
             description = ""
-        priority = (
-            " ❗" if self.priority >= 4 else
-            " ❕" if self.priority >= 2 else
-            ""
-        )
+        priority = _PRIORITY_MARKERS.get(self.priority, "")
         return f"- [{completed}] {self.title}{priority} " \
                f"[🔗][{self.id}]{description}\n"
 
-    def to_markdown_ref(self) -> str:
+    def _render_markdown_ref(self) -> str:
         return f"[{self.id}]: {self.url}\n"
+
+    def to_markdown(self) -> str:
+        return self._markdown
+
+    def to_markdown_ref(self) -> str:
+        return self._markdown_ref